@@ -0,0 +1,29 @@
+"""
+Legacy CSV column handling shared by the batch readers (isolation forest
+runner, correlation job).
+"""
+import pandas as pd
+
+# Columns (and dtypes) used from the legacy transfers.csv; read with the
+# multi-threaded pyarrow CSV engine, which skips every other column.
+# timestamp_unix stays float64: older exporters wrote fractional seconds.
+# Older CSVs lack some of these (site, timestamp_unix instead of timestamp);
+# only the columns in the header are read, see csv_columns().
+TRANSFERS_CSV_DTYPES = {
+    "timestamp_unix": "float64",
+    "timestamp": "float64",
+    "bytes": "int64",
+    "duration": "float32",
+    "throughput_bytes_per_sec": "float32",
+    "site": "category",
+}
+
+
+def csv_columns(path, dtypes):
+    """
+    The entries of `dtypes` whose column is in the CSV header, so a CSV
+    written before a column existed still reads and the missing column
+    falls through to the caller's defaults.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    return {col: dtype for col, dtype in dtypes.items() if col in header}
@@ -0,0 +1,51 @@
+"""
+Numeric kernels shared by the batch jobs.
+
+Compiled with Numba when it is installed; otherwise the same functions fall
+back to NumPy, so callers do not need to check which one they got.
+"""
+# Optional JIT backend
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+HAVE_NUMBA = njit is not None
+
+
+if HAVE_NUMBA:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def centered_sums(x, y):
+        """
+        Return (sum dx*dy, sum dx*dx, sum dy*dy) with dx, dy the deviations of
+        two float64 arrays from their means. Two passes (means, then centered
+        products) keep the result stable for large, offset values.
+        """
+        n = x.size
+        sx = 0.0
+        sy = 0.0
+        for i in prange(n):
+            sx += x[i]
+            sy += y[i]
+        mx = sx / n
+        my = sy / n
+
+        sxy = 0.0
+        sxx = 0.0
+        syy = 0.0
+        for i in prange(n):
+            dx = x[i] - mx
+            dy = y[i] - my
+            sxy += dx * dy
+            sxx += dx * dx
+            syy += dy * dy
+        return sxy, sxx, syy
+
+else:
+
+    def centered_sums(x, y):
+        """NumPy version of the Numba kernel above."""
+        dx = x - x.mean()
+        dy = y - y.mean()
+        return float(dx @ dy), float(dx @ dx), float(dy @ dy)
@@ -1,8 +1,16 @@
+import io
+import json
+import os
 import time
 import sys
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed, parallel_backend
 from prometheus_client import start_http_server, Gauge
 from sklearn.ensemble import IsolationForest
 
@@ -11,8 +19,26 @@ sys.stdout.reconfigure(line_buffering=True)
 
 
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
-TRANSFERS_CSV = DATA_DIR / "transfers.csv"
-ANOMALIES_CSV = DATA_DIR / "anomalies.csv"
+TRANSFERS_DIR = DATA_DIR / "transfers"
+TRANSFERS_CSV = DATA_DIR / "transfers.csv"  # legacy, pre-Parquet layout
+# Hive-partitioned like the transfers: data/anomalies/site=<SITE>/anomalies.parquet,
+# so a tick only rewrites the files of the sites whose scores changed
+ANOMALIES_DIR = DATA_DIR / "anomalies"
+
+# Rows per row group in the anomaly files; rows are sorted by time so the
+# correlation job can skip old row groups from their min/max statistics
+ANOMALIES_ROW_GROUP_ROWS = 10_000
+
+ANOMALIES_SCHEMA = pa.schema(
+    [
+        ("bytes", pa.float32()),
+        ("duration", pa.float32()),
+        ("throughput_bytes_per_sec", pa.float32()),
+        ("timestamp_unix", pa.float64()),
+        ("anomaly_label", pa.int64()),
+        ("anomaly_score", pa.float64()),
+    ]
+)
 
 # Prometheus metrics (now per site)
 ANOMALY_COUNT = Gauge(
@@ -33,85 +59,315 @@ ANOMALY_SCORE_MIN = Gauge(
     ["site"],
 )
 
+# site -> (count, ratio, score_min) labelled gauge children, so each tick
+# skips the labels() lookup and lock on the parent gauges
+_HANDLES = {}
 
-def load_data():
-    if not TRANSFERS_CSV.exists():
-        print(f"[ANOMALY_EXPORTER] No transfers.csv found at {TRANSFERS_CSV}")
-        return None
 
+def site_gauges(site):
+    """Return the (count, ratio, score_min) gauge children for `site`."""
+    handles = _HANDLES.get(site)
+    if handles is None:
+        handles = (
+            ANOMALY_COUNT.labels(site=site),
+            ANOMALY_RATIO.labels(site=site),
+            ANOMALY_SCORE_MIN.labels(site=site),
+        )
+        _HANDLES[site] = handles
+    return handles
+
+
+FEATURE_COLS = ["bytes", "duration", "throughput_bytes_per_sec"]
+
+# Each tree is fit on at most MAX_SAMPLES rows (sklearn's max_samples="auto"
+# cap). A site's model is refit only while its sample is not full yet or
+# when the site's row count crosses into a new REFIT_ROWS bucket; in
+# between, the model is reused and only the newly arrived rows are scored.
+MAX_SAMPLES = 256
+REFIT_ROWS = 10_000
+
+# Incremental state carried across update_metrics() ticks, so each tick only
+# parses and scores the rows that arrived since the previous one.
+_STATE = {
+    "files": set(),  # Parquet files already ingested (immutable once renamed)
+    "offset": 0,  # byte offset already consumed from the legacy transfers.csv
+    "csv_columns": None,
+    "sites": {},  # site -> per-site state, see new_site_state()
+}
+
+
+def new_site_state():
+    """Running feature matrix, scores, anomaly summary and model of a single site."""
+    return {
+        "X": np.empty((0, len(FEATURE_COLS)), dtype=np.float32),
+        "timestamps": np.empty(0, dtype=np.float64),
+        "scores": np.empty(0, dtype=np.float64),
+        "anomaly_idx": np.empty(0, dtype=np.int64),  # rows of X scored as anomalous
+        "min_score": np.inf,
+        "model": None,
+        "model_key": None,  # (rows fit on, capped at MAX_SAMPLES; rows // REFIT_ROWS)
+    }
+
+
+def read_files(files):
+    """Read the used columns of `files`, with site from their partition directory."""
+    return ds.dataset(
+        files,
+        format="parquet",
+        partitioning="hive",
+        partition_base_dir=str(TRANSFERS_DIR),
+    ).to_table(columns=FEATURE_COLS + ["site", "timestamp_unix"])
+
+
+def unseen_rows(hour_file, seen):
+    """
+    Rows of a compacted hour file that did not come from an already ingested
+    source file, using the source -> [start, stop) row ranges the exporter
+    stores in the file's metadata. Ranges overlap when the file was compacted
+    from an earlier hour file (both it and its parts are named); a row is
+    skipped if any source covering it was ingested.
+    """
+    table = read_files([hour_file])
+    meta = pq.read_schema(hour_file).metadata or {}
+    ranges = json.loads(meta.get(b"dtms_sources", b"{}"))
+    if not ranges:
+        return table
+
+    base = os.path.dirname(hour_file)
+    ingested = np.zeros(table.num_rows, dtype=bool)
+    for name, (start, stop) in ranges.items():
+        if os.path.join(base, name) in seen:
+            ingested[start:stop] = True
+    return table.filter(pa.array(~ingested))
+
+
+def read_new_parquet_rows():
+    """
+    Scan only the Parquet files not ingested yet, materializing the feature
+    columns plus site/timestamp. Part files are read whole; an hour file
+    compacted from parts is read without the rows of parts already ingested.
+    """
+    dataset = ds.dataset(TRANSFERS_DIR, format="parquet", partitioning="hive")
+    new_files = [f for f in dataset.files if f not in _STATE["files"]]
+    if not new_files:
+        return pd.DataFrame()
+
+    parts = [f for f in new_files if not os.path.basename(f).startswith("hour-")]
+    hour_files = [f for f in new_files if os.path.basename(f).startswith("hour-")]
+
+    tables = [read_files(parts)] if parts else []
+    seen = _STATE["files"].union(parts)
+    tables += [unseen_rows(f, seen) for f in hour_files]
+
+    # Only files still on disk are kept, so the set does not grow as parts
+    # are compacted away
+    _STATE["files"] = set(dataset.files)
+    return pa.concat_tables(tables).to_pandas()
+
+
+def read_new_csv_rows():
+    """
+    Tail the legacy transfers.csv from the last consumed byte offset.
+    Only complete lines are consumed; a partially written last line is
+    picked up on the next tick.
+    """
+    with open(TRANSFERS_CSV, "rb") as f:
+        f.seek(_STATE["offset"])
+        new = f.read()
+
+    end = new.rfind(b"\n") + 1
+    if end == 0:
+        return pd.DataFrame()
+
+    if _STATE["csv_columns"] is None:
+        # First read includes the header line
+        df = pd.read_csv(io.BytesIO(new[:end]), on_bad_lines='skip')
+        _STATE["csv_columns"] = list(df.columns)
+    else:
+        df = pd.read_csv(
+            io.BytesIO(new[:end]),
+            names=_STATE["csv_columns"],
+            header=None,
+            on_bad_lines='skip',
+        )
+
+    _STATE["offset"] += end
+    return df
+
+
+def load_data():
+    """
+    Return the transfer rows that arrived since the previous call,
+    or None if there are none.
+    """
     try:
-        # on_bad_lines='skip' is the correct parameter for pandas 2.x
-        df = pd.read_csv(TRANSFERS_CSV, on_bad_lines='skip')
+        if TRANSFERS_DIR.exists():
+            df = read_new_parquet_rows()
+        elif TRANSFERS_CSV.exists():
+            df = read_new_csv_rows()
+        else:
+            print(f"[ANOMALY_EXPORTER] No transfers dataset found at {TRANSFERS_DIR}")
+            return None
         if df.empty:
-            print("[ANOMALY_EXPORTER] CSV is empty after skipping bad lines")
             return None
     except Exception as e:
-        print(f"[ANOMALY_EXPORTER] Error reading CSV: {e}")
+        print(f"[ANOMALY_EXPORTER] Error reading transfers: {e}")
         return None
 
-    # Basic filtering
-    df = df[df["duration"] > 0].copy()
-    if df.empty:
-        print("[ANOMALY_EXPORTER] No valid rows after filtering")
+    # Ensure we have a site column (for multi-site metrics)
+    if "site" not in df.columns:
+        df["site"] = "UNKNOWN"
+    # Older CSVs carry the time as "timestamp"
+    if "timestamp_unix" not in df.columns and "timestamp" in df.columns:
+        df["timestamp_unix"] = df["timestamp"]
+
+    missing = [c for c in FEATURE_COLS + ["timestamp_unix"] if c not in df.columns]
+    if missing:
+        print(f"[ANOMALY_EXPORTER] Skipping {len(df)} rows without columns {missing}")
         return None
 
+    # Fill on the freshly read frame, which owns its data, then filter and
+    # keep only the columns used downstream in one selection: no extra copy
+    # of unused (string) columns from the legacy CSV
     df["throughput_bytes_per_sec"] = df["throughput_bytes_per_sec"].fillna(0)
+    df = df.loc[df["duration"].to_numpy() > 0, FEATURE_COLS + ["timestamp_unix", "site"]]
+    if df.empty:
+        return None
 
-    # Ensure we have a site column (for multi-site metrics)
-    if "site" not in df.columns:
-        df["site"] = "UNKNOWN"
+    return df.astype({col: np.float32 for col in FEATURE_COLS})
 
-    return df
 
+def ingest(df):
+    """
+    Append newly loaded rows to their site's running feature matrix.
+    Returns {site: number of new rows}.
+    """
+    new_rows = {}
+    for site, g in df.groupby("site", sort=False):
+        st = _STATE["sites"].setdefault(site, new_site_state())
+        st["X"] = np.concatenate(
+            [st["X"], g[FEATURE_COLS].to_numpy(dtype=np.float32)]
+        )
+        st["timestamps"] = np.concatenate(
+            [st["timestamps"], g["timestamp_unix"].to_numpy(dtype=np.float64)]
+        )
+        new_rows[site] = len(g)
+    return new_rows
+
+
+def score_rows(model, X):
+    """
+    Return the decision function for X (lower = more abnormal, negative =
+    anomaly, as predict() would label it). Trees are walked in parallel threads.
+    """
+    with parallel_backend("threading", n_jobs=-1):
+        return model.decision_function(X)
+
+
+def update_site_scores(st, n_new):
+    """
+    Score the last `n_new` rows of one site's feature matrix and fold them
+    into the site's anomaly index and min score. When the site's model key
+    changed, its IsolationForest is refit and all its rows are rescored.
+    """
+    X = st["X"]
+    model_key = (min(len(X), MAX_SAMPLES), len(X) // REFIT_ROWS)
+    if st["model_key"] != model_key:
+        # sklearn's defaults, pinned explicitly: max_samples=model_key[0] is
+        # what max_samples="auto" picks, max_features=1.0 and bootstrap=False
+        model = IsolationForest(
+            n_estimators=100,
+            contamination=0.05,
+            max_samples=model_key[0],
+            max_features=1.0,
+            bootstrap=False,
+            n_jobs=-1,
+            random_state=42,
+        )
+        model.fit(X)
 
-def compute_anomalies(df):
-    feature_cols = ["bytes", "duration", "throughput_bytes_per_sec"]
-    X = df[feature_cols].values
+        st["model"] = model
+        st["model_key"] = model_key
+        st["scores"] = score_rows(model, X)
+        st["anomaly_idx"] = np.flatnonzero(st["scores"] < 0)
+        st["min_score"] = st["scores"].min()
+        return
 
-    model = IsolationForest(
-        n_estimators=100, contamination=0.05, random_state=42
+    start = len(X) - n_new
+    scores = score_rows(st["model"], X[start:])
+    st["scores"] = np.concatenate([st["scores"], scores])
+    st["anomaly_idx"] = np.concatenate(
+        [st["anomaly_idx"], start + np.flatnonzero(scores < 0)]
+    )
+    st["min_score"] = min(st["min_score"], scores.min())
+
+
+def compute_anomalies(new_rows):
+    """
+    Update the sites that received rows, one IsolationForest per site so
+    anomalies are judged against the site's own traffic. Sites are
+    independent, so they run in parallel threads (sklearn releases the GIL
+    while building and walking trees).
+    """
+    Parallel(n_jobs=-1, backend="threading")(
+        delayed(update_site_scores)(_STATE["sites"][site], n_new)
+        for site, n_new in new_rows.items()
     )
-    model.fit(X)
 
-    labels = model.predict(X)  # -1 anomaly, 1 normal
-    scores = model.decision_function(X)
 
-    df["anomaly_label"] = labels
-    df["anomaly_score"] = scores
+def save_site_anomalies(site, st):
+    """
+    Write one site's anomalous rows, sorted by time, to a temp file and
+    rename it over site=<SITE>/anomalies.parquet, so the correlation job
+    never reads a partial file. Only the anomalous rows are gathered.
+    """
+    idx = st["anomaly_idx"][np.argsort(st["timestamps"][st["anomaly_idx"]], kind="stable")]
+    X = st["X"][idx]
+    table = pa.table(
+        {
+            "bytes": X[:, 0],
+            "duration": X[:, 1],
+            "throughput_bytes_per_sec": X[:, 2],
+            "timestamp_unix": st["timestamps"][idx],
+            "anomaly_label": np.full(len(idx), -1, dtype=np.int64),
+            "anomaly_score": st["scores"][idx],
+        },
+        schema=ANOMALIES_SCHEMA,
+    )
 
-    return df
+    site_dir = ANOMALIES_DIR / f"site={site}"
+    site_dir.mkdir(parents=True, exist_ok=True)
+    path = site_dir / "anomalies.parquet"
+    tmp_path = site_dir / f".{path.name}.tmp"
+    pq.write_table(table, tmp_path, row_group_size=ANOMALIES_ROW_GROUP_ROWS)
+    tmp_path.replace(path)
 
 
 def update_metrics():
-    df = load_data()
-    if df is None:
-        # No data yet; do not update metrics
-        print("[ANOMALY_EXPORTER] No data available; metrics not updated.")
+    new_df = load_data()
+    if new_df is None:
+        # Nothing arrived since the last tick; metrics are still current
+        print("[ANOMALY_EXPORTER] No new data; metrics not updated.")
         return
 
-    df = compute_anomalies(df)
-
-    # Save anomalies to CSV for correlation job
-    anomalies_df = df[df["anomaly_label"] == -1].copy()
-    if not anomalies_df.empty:
-        # Ensure we have the columns needed by correlation job
-        if "timestamp_unix" not in anomalies_df.columns and "timestamp" in anomalies_df.columns:
-            anomalies_df["timestamp_unix"] = anomalies_df["timestamp"]
-        ANOMALIES_CSV.parent.mkdir(parents=True, exist_ok=True)
-        anomalies_df.to_csv(ANOMALIES_CSV, index=False)
-        print(f"[ANOMALY_EXPORTER] Saved {len(anomalies_df)} anomalies to {ANOMALIES_CSV}")
+    new_rows = ingest(new_df)
+    compute_anomalies(new_rows)
 
-    # Compute metrics per site
-    for site, site_df in df.groupby("site"):
-        total = len(site_df)
-        anomalies = (site_df["anomaly_label"] == -1).sum()
+    # Only the sites that received rows changed: rewrite their anomaly files
+    # (for the correlation job) and gauges from the running per-site summary
+    for site in new_rows:
+        st = _STATE["sites"][site]
+        save_site_anomalies(site, st)
 
+        total = len(st["scores"])
+        anomalies = len(st["anomaly_idx"])
+        min_score = st["min_score"]
         ratio = anomalies / total if total > 0 else 0.0
-        min_score = site_df["anomaly_score"].min() if not site_df.empty else 0.0
 
-        ANOMALY_COUNT.labels(site=site).set(float(anomalies))
-        ANOMALY_RATIO.labels(site=site).set(float(ratio))
-        ANOMALY_SCORE_MIN.labels(site=site).set(float(min_score))
+        count_gauge, ratio_gauge, score_min_gauge = site_gauges(site)
+        count_gauge.set(float(anomalies))
+        ratio_gauge.set(float(ratio))
+        score_min_gauge.set(float(min_score))
 
         print(
             f"[ANOMALY_EXPORTER] site={site} total={total} anomalies={anomalies} "
@@ -1,23 +1,65 @@
+import os
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+from joblib import parallel_backend
 from sklearn.ensemble import IsolationForest
 
+from anomaly._csv import TRANSFERS_CSV_DTYPES, csv_columns
 
-DATA_DIR = Path(__file__).resolve().parent.parent / "data"
-TRANSFERS_CSV = DATA_DIR / "transfers.csv"
-ANOMALIES_CSV = DATA_DIR / "anomalies.csv"
+# Optional GPU backend (RAPIDS cuML), used only when DTMS_USE_GPU_IF=1
+try:
+    import cudf
+    from cuml.ensemble import IsolationForest as GPUIsolationForest
+except ImportError:
+    cudf = None
+    GPUIsolationForest = None
 
+USE_GPU_IF = os.getenv("DTMS_USE_GPU_IF", "0") == "1"
 
-def load_data() -> pd.DataFrame:
-    if not TRANSFERS_CSV.exists():
-        raise FileNotFoundError(f"No transfers.csv found at {TRANSFERS_CSV}")
 
-    df = pd.read_csv(TRANSFERS_CSV)
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+TRANSFERS_DIR = DATA_DIR / "transfers"
+TRANSFERS_CSV = DATA_DIR / "transfers.csv"  # legacy, pre-Parquet layout
+# Same per-site layout the anomaly exporter writes: anomalies/site=<SITE>/anomalies.parquet
+ANOMALIES_DIR = DATA_DIR / "anomalies"
+# Column types of the anomaly files, matching the anomaly exporter's schema
+ANOMALIES_DTYPES = {
+    "bytes": "float32",
+    "duration": "float32",
+    "throughput_bytes_per_sec": "float32",
+    "timestamp_unix": "float64",
+    "anomaly_label": "int64",
+    "anomaly_score": "float64",
+}
 
-    # Basic sanity filters: drop weird/zero durations
-    df = df[df["duration"] > 0].copy()
+
+def load_data() -> pd.DataFrame:
+    if TRANSFERS_DIR.exists():
+        dataset = ds.dataset(TRANSFERS_DIR, format="parquet", partitioning="hive")
+        df = dataset.to_table().to_pandas()
+    elif TRANSFERS_CSV.exists():
+        dtypes = csv_columns(TRANSFERS_CSV, TRANSFERS_CSV_DTYPES)
+        df = pd.read_csv(
+            TRANSFERS_CSV,
+            engine="pyarrow",
+            usecols=list(dtypes),
+            dtype=dtypes,
+        )
+    else:
+        raise FileNotFoundError(f"No transfers dataset found at {TRANSFERS_DIR}")
+
+    if "timestamp_unix" not in df.columns and "timestamp" in df.columns:
+        df["timestamp_unix"] = df["timestamp"]
+    if "site" not in df.columns:
+        df["site"] = "UNKNOWN"
+
+    # Basic sanity filters: drop weird/zero durations. Fill first, on the
+    # frame that owns its data, so the filtered frame needs no extra copy.
     df["throughput_bytes_per_sec"] = df["throughput_bytes_per_sec"].fillna(0)
+    df = df.loc[df["duration"].to_numpy() > 0]
 
     return df
 
@@ -26,33 +68,87 @@ def run_isolation_forest(df: pd.DataFrame) -> pd.DataFrame:
     # Features for anomaly detection
     feature_cols = ["bytes", "duration", "throughput_bytes_per_sec"]
 
-    X = df[feature_cols].values
+    if USE_GPU_IF:
+        if GPUIsolationForest is not None:
+            return run_isolation_forest_gpu(df, feature_cols)
+        print("DTMS_USE_GPU_IF=1 but cuML is not available; using scikit-learn")
 
-    # IsolationForest: unsupervised anomaly detection
+    # Contiguous float32: the tree builder's native dtype, so no extra copy
+    X = np.ascontiguousarray(df[feature_cols].to_numpy(), dtype=np.float32)
+
+    # IsolationForest: unsupervised anomaly detection. max_samples,
+    # max_features and bootstrap are sklearn's defaults (max_samples="auto"
+    # is min(256, rows)), pinned explicitly so the GPU path can match them
     model = IsolationForest(
         n_estimators=100,
         contamination=0.05,  # ~5% of points considered anomalies
+        max_samples=min(256, len(X)),
+        max_features=1.0,
+        bootstrap=False,
+        n_jobs=-1,
+        random_state=42,
+    )
+
+    model.fit(X)
+
+    # Scoring only parallelizes across trees under a threading backend
+    with parallel_backend("threading", n_jobs=-1):
+        scores = model.decision_function(X)
+
+    # Predictions: -1 = anomaly, 1 = normal (same rule as model.predict)
+    df["anomaly_label"] = np.where(scores < 0, -1, 1)
+    # Decision function: lower = more abnormal
+    df["anomaly_score"] = scores
+
+    return df
+
+
+def run_isolation_forest_gpu(df: pd.DataFrame, feature_cols: list) -> pd.DataFrame:
+    # Same parameters and float32 input as the CPU path, with all trees built
+    # on the GPU, so DTMS_USE_GPU_IF does not change which rows are flagged
+    X = cudf.DataFrame.from_pandas(df[feature_cols].astype(np.float32))
+
+    model = GPUIsolationForest(
+        n_estimators=100,
+        contamination=0.05,
+        max_samples=min(256, len(X)),
+        max_features=1.0,
+        bootstrap=False,
         random_state=42,
     )
 
     model.fit(X)
 
-    # Predictions: -1 = anomaly, 1 = normal
-    df["anomaly_label"] = model.predict(X)
     # Decision function: lower = more abnormal
-    df["anomaly_score"] = model.decision_function(X)
+    scores = model.decision_function(X).to_pandas().to_numpy()
+    # Predictions: -1 = anomaly, 1 = normal (same rule as the CPU path)
+    df["anomaly_label"] = np.where(scores < 0, -1, 1)
+    df["anomaly_score"] = scores
 
     return df
 
 
 def save_anomalies(df: pd.DataFrame) -> None:
-    anomalies = df[df["anomaly_label"] == -1].copy()
-    anomalies.to_csv(ANOMALIES_CSV, index=False)
-    print(f"Saved {len(anomalies)} anomalies to {ANOMALIES_CSV}")
+    # Sorted by time so readers can skip old row groups via their statistics
+    anomalies = df[df["anomaly_label"] == -1].sort_values("timestamp_unix")
+    by_site = dict(tuple(anomalies.groupby("site", sort=False, observed=True)))
+    for site in df["site"].unique():
+        # Every scored site is rewritten, so a site with no anomalies left
+        # does not keep serving a stale file
+        site_anomalies = by_site.get(site, anomalies.iloc[:0])[list(ANOMALIES_DTYPES)]
+        site_dir = ANOMALIES_DIR / f"site={site}"
+        site_dir.mkdir(parents=True, exist_ok=True)
+        path = site_dir / "anomalies.parquet"
+        tmp_path = site_dir / f".{path.name}.tmp"
+        site_anomalies.astype(ANOMALIES_DTYPES).to_parquet(
+            tmp_path, index=False, row_group_size=10_000
+        )
+        tmp_path.replace(path)
+    print(f"Saved {len(anomalies)} anomalies to {ANOMALIES_DIR}")
 
 
 def main() -> None:
-    print(f"Loading data from {TRANSFERS_CSV} ...")
+    print(f"Loading data from {TRANSFERS_DIR} ...")
     df = load_data()
     print(f"Loaded {len(df)} records")
 
@@ -62,7 +158,7 @@ def main() -> None:
     top_anomalies = df_with_scores.sort_values("anomaly_score").head(10)
     print("\nTop 10 most anomalous transfers:")
     print(top_anomalies[[
-        "timestamp_iso",
+        "timestamp_unix",
         "bytes",
         "duration",
         "throughput_bytes_per_sec",
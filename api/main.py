@@ -1,16 +1,38 @@
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Dict
+from typing import Any, Callable, List, Dict, Tuple
 
+import asyncio
 import time
 import os
 import re
-import requests
-import pandas as pd
-from fastapi import FastAPI, HTTPException
+import httpx
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One keep-alive connection pool for all scrapes of the anomaly exporter,
+    # shared by every request of this app lifecycle
+    async with httpx.AsyncClient(
+        timeout=5.0,
+        transport=httpx.AsyncHTTPTransport(retries=2),
+    ) as client:
+        app.state.http = client
+        # Locks are made here, not at import: an asyncio.Lock binds to the
+        # event loop it is first waited on, and each lifecycle has its own loop
+        app.state.anomaly_lock = asyncio.Lock()
+        app.state.cache_locks = {}  # cache name -> lock, see cached()
+        yield
+
+
 # Enable CORS for external CDN resources
 app = FastAPI(
     title="DTMS Monitoring API",
@@ -19,6 +41,7 @@ app = FastAPI(
     docs_url="/docs",
     openapi_url="/openapi.json",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 # Add CORS middleware to allow Swagger UI to load from CDN
@@ -35,86 +58,227 @@ app.add_middleware(
 # -----------------------------
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / "data"
-TRANSFERS_CSV = DATA_DIR / "transfers.csv"
+TRANSFERS_DIR = DATA_DIR / "transfers"
+TRANSFERS_CSV = DATA_DIR / "transfers.csv"  # legacy, pre-Parquet layout
 
 PARQUET_DIR = BASE_DIR / "sample_data" / "parquet" / "site_aggregates"
 
+# Rows per record batch when streaming the aggregates dataset
+AGGREGATES_BATCH_ROWS = 65_536
+
 ANOMALY_METRICS_URL = os.getenv(
     "ANOMALY_METRICS_URL",
     "http://anomaly:8001/metrics",
 )
-def load_sites_from_transfers() -> List[str]:
+
+# Anomaly metrics are recomputed every 30s by the exporter; serve a scraped
+# snapshot for this many seconds before fetching again.
+ANOMALY_CACHE_TTL = 10.0
+
+# Only lines starting with one of these prefixes reach the regex; the rest
+# of the exporter's /metrics body (HELP/TYPE, process and GC metrics) is
+# skipped with a cheap startswith check.
+ANOMALY_LINE_PREFIXES = (
+    "dtms_anomaly_count{",
+    "dtms_anomaly_ratio{",
+    "dtms_anomaly_score_min{",
+)
+ANOMALY_LINE_RE = re.compile(
+    r'^dtms_anomaly_(?P<key>count|ratio|score_min)\{site="(?P<site>[^"]+)"\}\s+(?P<value>[-0-9\.eE]+)$'
+)
+
+_anomaly_cache = {"t": 0.0, "val": None}
+
+# Cache for file-backed loaders: name -> (mtime key of its source paths, value)
+_CACHE: Dict[str, Tuple[Tuple[int, ...], Any]] = {}
+
+
+def mtime_key(path: Path) -> int:
+    """
+    Latest st_mtime_ns of `path` and, for a directory, of its direct
+    subdirectories: the datasets are partitioned one level deep
+    (site=<SITE>/), and renaming a new part into its partition directory
+    bumps that directory's mtime. Returns 0 if `path` does not exist.
+    """
+    try:
+        latest = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+    if not path.is_dir():
+        return latest
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                latest = max(latest, entry.stat().st_mtime_ns)
+    return latest
+
+
+def mtime_keys(paths: List[Path]) -> Tuple[int, ...]:
+    return tuple(mtime_key(p) for p in paths)
+
+
+async def cached(name: str, paths: List[Path], loader: Callable[[], Any]) -> Any:
+    """
+    Return the cached result of `loader` while none of `paths` changed;
+    otherwise re-run it in a worker thread. The stat calls run in a worker
+    thread too, so the event loop never touches the filesystem. Concurrent
+    requests for the same name wait on one reload instead of each reading
+    the files.
+    """
+    # One lock per cache name, so a slow reload of one endpoint never blocks another
+    async with app.state.cache_locks.setdefault(name, asyncio.Lock()):
+        key = await asyncio.to_thread(mtime_keys, paths)
+        hit = _CACHE.get(name)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+
+        value = await asyncio.to_thread(loader)
+        _CACHE[name] = (key, value)
+        return value
+
+
+def site_partitions() -> Dict[str, Path]:
+    """
+    Map each site to its site=<SITE> partition directory. Sites come from
+    the directory names alone, so no Parquet file is opened.
+    """
+    return {
+        p.name.split("=", 1)[1]: p
+        for p in TRANSFERS_DIR.glob("site=*")
+        if p.is_dir()
+    }
+
+
+def newest_parts(partition: Path) -> List[Path]:
+    """
+    Return the files of a partition that can hold its latest transfer.
+    Parts are named part-<timestamp of first row>-<writer id>.parquet and a
+    site can have several writers, so this is the newest part of each
+    writer. Closed hours are compacted into hour-<hour start>-<ns>.parquet
+    files; the newest of those is included too, for writers whose parts
+    were all compacted.
+    """
+    newest: Dict[str, Tuple[int, Path]] = {}
+    for p in list(partition.glob("part-*.parquet")) + list(partition.glob("hour-*.parquet")):
+        prefix, ts, *writer = p.stem.split("-", 2)
+        group = writer[0] if prefix == "part" and writer else prefix
+        if group not in newest or int(ts) > newest[group][0]:
+            newest[group] = (int(ts), p)
+    return [p for _, p in newest.values()]
+
+
+def load_legacy_transfers(columns: List[str]) -> pa.Table:
+    """
+    Read only `columns` from the legacy transfers.csv. The CSV reader skips
+    conversion of every other column; missing columns come back null.
+    """
     if not TRANSFERS_CSV.exists():
-        return []
+        return pa.table({})
+
+    return pacsv.read_csv(
+        TRANSFERS_CSV,
+        convert_options=pacsv.ConvertOptions(
+            include_columns=columns,
+            include_missing_columns=True,
+            strings_can_be_null=True,
+        ),
+    )
+
 
-    df = pd.read_csv(TRANSFERS_CSV)
-    if "site" not in df.columns:
+def load_sites_from_transfers() -> List[str]:
+    if TRANSFERS_DIR.exists():
+        return sorted(site_partitions())
+
+    tbl = load_legacy_transfers(["site"])
+    if tbl.num_rows == 0:
         return []
 
-    sites = sorted(df["site"].dropna().unique().tolist())
-    return sites
+    return sorted(pc.unique(tbl["site"].drop_null()).to_pylist())
 
 
 def load_aggregates_from_parquet() -> List[Dict]:
     if not PARQUET_DIR.exists():
         raise FileNotFoundError(f"No Parquet directory found at {PARQUET_DIR}")
 
-    # Read all Parquet files under site_aggregates
-    df = pd.read_parquet(PARQUET_DIR.as_posix())
+    # Stream all Parquet files under site_aggregates batch by batch
+    dataset = ds.dataset(PARQUET_DIR, format="parquet", partitioning="hive")
 
     # If no src_site column, bail out
-    if "src_site" not in df.columns:
+    if "src_site" not in dataset.schema.names:
         raise ValueError("Parquet data does not contain 'src_site' column.")
 
-    # Group per src_site and compute averages of the aggregate metrics themselves
-    grouped = (
-        df.groupby("src_site")
-        .agg(
-            avg_bytes=("avg_bytes", "mean"),
-            avg_latency_ms=("avg_latency", "mean"),
-        )
-        .reset_index()
+    # Per src_site running [sum, count] of avg_bytes and avg_latency, so
+    # memory stays bounded by the number of sites, not the number of rows
+    totals: Dict[str, List[float]] = {}
+    batches = dataset.to_batches(
+        columns=["src_site", "avg_bytes", "avg_latency"],
+        batch_size=AGGREGATES_BATCH_ROWS,
     )
-
-    records = grouped.to_dict(orient="records")
+    for batch in batches:
+        partial = pa.Table.from_batches([batch]).group_by("src_site").aggregate(
+            [
+                ("avg_bytes", "sum"),
+                ("avg_bytes", "count"),
+                ("avg_latency", "sum"),
+                ("avg_latency", "count"),
+            ]
+        )
+        for row in partial.to_pylist():
+            if row["src_site"] is None:
+                continue
+            acc = totals.setdefault(row["src_site"], [0.0, 0, 0.0, 0])
+            acc[0] += row["avg_bytes_sum"] or 0.0
+            acc[1] += row["avg_bytes_count"]
+            acc[2] += row["avg_latency_sum"] or 0.0
+            acc[3] += row["avg_latency_count"]
+
+    # Average the aggregate metrics themselves per src_site
+    records = [
+        {
+            "src_site": site,
+            "avg_bytes": sum_b / n_b if n_b else None,
+            "avg_latency_ms": sum_l / n_l if n_l else None,
+        }
+        for site, (sum_b, n_b, sum_l, n_l) in sorted(totals.items())
+    ]
     return records
 
 
-def load_anomalies_from_metrics() -> List[Dict]:
+async def load_anomalies_from_metrics(client: httpx.AsyncClient) -> List[Dict]:
     """
     Scrape the anomaly exporter's /metrics endpoint and extract
-    dtms_anomaly_* metrics per site.
+    dtms_anomaly_* metrics per site. Results are cached for
+    ANOMALY_CACHE_TTL seconds; concurrent requests on an expired cache
+    wait on one scrape.
     """
-    try:
-        resp = requests.get(ANOMALY_METRICS_URL, timeout=5)
-        resp.raise_for_status()
-    except Exception as e:
-        raise RuntimeError(f"Failed to fetch anomaly metrics: {e}")
+    async with app.state.anomaly_lock:
+        if _anomaly_cache["val"] is not None and time.time() - _anomaly_cache["t"] < ANOMALY_CACHE_TTL:
+            return _anomaly_cache["val"]
 
-    text = resp.text
+        anomalies = await scrape_anomaly_metrics(client)
+        _anomaly_cache["t"] = time.time()
+        _anomaly_cache["val"] = anomalies
+        return anomalies
 
-    # Patterns for our three metrics
-    patterns = {
-        "count": re.compile(r'^dtms_anomaly_count\{site="(?P<site>[^"]+)"\}\s+(?P<value>[-0-9\.eE]+)$'),
-        "ratio": re.compile(r'^dtms_anomaly_ratio\{site="(?P<site>[^"]+)"\}\s+(?P<value>[-0-9\.eE]+)$'),
-        "score_min": re.compile(r'^dtms_anomaly_score_min\{site="(?P<site>[^"]+)"\}\s+(?P<value>[-0-9\.eE]+)$'),
-    }
 
+async def scrape_anomaly_metrics(client: httpx.AsyncClient) -> List[Dict]:
+    """Fetch and parse the dtms_anomaly_* lines of the exporter's /metrics body."""
     result: Dict[str, Dict[str, float]] = {}
 
-    for line in text.splitlines():
-        line = line.strip()
-        if line.startswith("#") or not line:
-            continue
-
-        for key, pattern in patterns.items():
-            m = pattern.match(line)
-            if m:
-                site = m.group("site")
-                value = float(m.group("value"))
-                if site not in result:
-                    result[site] = {}
-                result[site][key] = value
+    try:
+        # Stream the body line by line instead of holding it as one string
+        async with client.stream("GET", ANOMALY_METRICS_URL) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith(ANOMALY_LINE_PREFIXES):
+                    continue
+
+                m = ANOMALY_LINE_RE.match(line.strip())
+                if m:
+                    result.setdefault(m.group("site"), {})[m.group("key")] = float(m.group("value"))
+    except Exception as e:
+        raise RuntimeError(f"Failed to fetch anomaly metrics: {e}")
 
     # Convert to list of dicts
     anomalies = []
@@ -127,7 +291,6 @@ def load_anomalies_from_metrics() -> List[Dict]:
                 "anomaly_score_min": vals.get("score_min", 0.0),
             }
         )
-
     return anomalies
 
 class FreshnessRecord(BaseModel):
@@ -136,46 +299,73 @@ class FreshnessRecord(BaseModel):
     age_seconds: float
 
 
-def compute_freshness_per_site() -> List[FreshnessRecord]:
+def load_latest_timestamps() -> Dict[str, float]:
     """
-    Returns per-site latest timestamp and age in seconds.
-    Logic: group by 'site' column if present; else single group 'UNKNOWN'.
+    Returns the latest transfer timestamp per site.
+    For the Parquet dataset only the newest part of each writer of a site
+    partition is read. For the legacy CSV: group by 'site' column if present; else single
+    group 'UNKNOWN', aggregated on the Arrow table, using 'timestamp' when the
+    CSV has no 'timestamp_unix'.
     """
-    now = time.time()
-    if not TRANSFERS_CSV.exists():
-        return []
+    if TRANSFERS_DIR.exists():
+        latest = {}
+        for site, partition in site_partitions().items():
+            parts = newest_parts(partition)
+            if not parts:
+                continue
+            ts = pc.max(
+                pq.ParquetDataset(parts).read(columns=["timestamp_unix"])["timestamp_unix"]
+            )
+            if ts.is_valid:
+                latest[site] = float(ts.as_py())
+        return latest
 
     try:
-        df = pd.read_csv(TRANSFERS_CSV)
+        tbl = load_legacy_transfers(["site", "timestamp_unix", "timestamp"])
     except Exception:
-        return []
+        return {}
+    if tbl.num_rows == 0:
+        return {}
+
+    # Older CSVs carry the time as "timestamp"; a column missing from the
+    # file comes back all-null with the null type
+    if pa.types.is_null(tbl["timestamp_unix"].type):
+        tbl = tbl.set_column(
+            tbl.schema.get_field_index("timestamp_unix"), "timestamp_unix", tbl["timestamp"]
+        )
 
-    if "timestamp_unix" not in df.columns and "timestamp" in df.columns:
-        # accommodate different timestamp names
-        df["timestamp_unix"] = df["timestamp"]
+    tbl = tbl.filter(pc.is_valid(tbl["timestamp_unix"]))
+    if tbl.num_rows == 0:
+        return {}
 
-    # Ensure numeric
-    df = df.dropna(subset=["timestamp_unix"])
-    if df.empty:
-        return []
+    # Rows without a site (or a CSV without the column) belong to UNKNOWN
+    site = tbl["site"]
+    if pa.types.is_null(site.type):
+        site = site.cast(pa.string())
+    tbl = tbl.set_column(
+        tbl.schema.get_field_index("site"), "site", pc.fill_null(site, "UNKNOWN")
+    )
+
+    grouped = tbl.group_by("site").aggregate([("timestamp_unix", "max")])
+    return {
+        str(row["site"]): float(row["timestamp_unix_max"])
+        for row in grouped.to_pylist()
+    }
 
-    if "site" in df.columns:
-        groups = df.groupby("site")
-    else:
-        # everything belongs to UNKNOWN site
-        df["site"] = "UNKNOWN"
-        groups = df.groupby("site")
+
+def compute_freshness_per_site(latest_per_site: Dict[str, float]) -> List[FreshnessRecord]:
+    """
+    Returns per-site latest timestamp and age in seconds.
+    Age is computed at call time so cached timestamps never go stale.
+    """
+    now = time.time()
 
     records = []
-    for site, g in groups:
-        try:
-            latest = float(g["timestamp_unix"].max())
-        except Exception:
-            continue
+    for site, latest in latest_per_site.items():
         age = now - latest
         records.append(
             FreshnessRecord(
-                site=str(site),
+                site=site,
                 latest_timestamp=latest,
                 age_seconds=round(age, 3),
             )
@@ -190,7 +380,7 @@ def compute_freshness_per_site() -> List[FreshnessRecord]:
 # API Endpoints
 # -----------------------------
 @app.get("/")
-def root():
+async def root():
     return {
         "service": "DTMS Monitoring API",
         "version": "0.1.0",
@@ -207,20 +397,24 @@ def root():
 
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok", "service": "dtms-api"}
 
 
 @app.get("/sites")
-def get_sites():
-    sites = load_sites_from_transfers()
+async def get_sites():
+    sites = await cached(
+        "sites", [TRANSFERS_DIR, TRANSFERS_CSV], load_sites_from_transfers
+    )
     return {"sites": sites}
 
 
 @app.get("/aggregates")
-def get_aggregates():
+async def get_aggregates():
     try:
-        records = load_aggregates_from_parquet()
+        records = await cached(
+            "aggregates", [PARQUET_DIR], load_aggregates_from_parquet
+        )
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -230,16 +424,16 @@ def get_aggregates():
 
 
 @app.get("/anomalies")
-def get_anomalies():
+async def get_anomalies(request: Request):
     try:
-        anomalies = load_anomalies_from_metrics()
+        anomalies = await load_anomalies_from_metrics(request.app.state.http)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to load anomalies: {e}")
 
     return {"anomalies": anomalies}
 
 @app.get("/freshness")
-def get_freshness() -> Dict[str, List[Dict]]:
+async def get_freshness() -> Dict[str, List[Dict]]:
     """
     Returns per-site data freshness: latest timestamp and age in seconds.
     
@@ -251,7 +445,10 @@ def get_freshness() -> Dict[str, List[Dict]]:
       ]
     }
     """
-    records = compute_freshness_per_site()
+    latest_per_site = await cached(
+        "freshness", [TRANSFERS_DIR, TRANSFERS_CSV], load_latest_timestamps
+    )
+    records = compute_freshness_per_site(latest_per_site)
     return {
         "sites": [
             {
@@ -1,10 +1,14 @@
-import csv
-from datetime import datetime, timezone
-
+import atexit
+import json
 import os
+import signal
+import socket
+import sys
 import time
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from prometheus_client import start_http_server, Counter, Histogram
 from simulator.transfer_simulator import simulate_single_transfer
 
@@ -38,49 +42,182 @@ TRANSFER_FAILURES = Counter(
 
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
 DATA_DIR.mkdir(exist_ok=True)
-TRANSFERS_CSV = DATA_DIR / "transfers.csv"
+# Hive-partitioned Parquet dataset:
+# data/transfers/site=<SITE_NAME>/part-<ts>-<WRITER_ID>.parquet, compacted
+# per hour into data/transfers/site=<SITE_NAME>/hour-<hour start>-<ns>.parquet
+TRANSFERS_DIR = DATA_DIR / "transfers"
+SITE_DIR = TRANSFERS_DIR / f"site={SITE_NAME}"
+
+# Several exporters can write the same site partition (duplicate deployments,
+# rolling-update overlap), so part and temp names carry a per-process id:
+# two flushes in the same second never rename over each other's file
+WRITER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+# Flush buffered records to a new Parquet file (one row group) once
+# FLUSH_ROWS records are buffered or FLUSH_SECONDS have passed.
+FLUSH_ROWS = 64
+FLUSH_SECONDS = 10
+
+# Every COMPACT_CHECK_SECONDS, merge the part files of each hour that closed
+# more than COMPACT_GRACE_SECONDS ago into one hour file, so readers see a
+# few files per site and day instead of thousands. The grace period lets
+# the anomaly exporter ingest the parts before they are merged. Any writer
+# of the site may compact an hour (a dead writer's parts are merged too);
+# a .compact-<hour>.lock file makes sure only one does.
+COMPACT_CHECK_SECONDS = 300
+COMPACT_GRACE_SECONDS = 600
+COMPACT_LOCK_STALE_SECONDS = 3600
+COMPACT_ROW_GROUP_ROWS = 65_536
+
+# Fixed schema so every part file agrees on types. No "site" column:
+# readers recover it from the site=<SITE_NAME> directory.
+SCHEMA = pa.schema(
+    [
+        ("timestamp_unix", pa.int64()),
+        ("bytes", pa.int64()),
+        ("duration", pa.float32()),
+        ("throughput_bytes_per_sec", pa.float32()),
+        ("status", pa.dictionary(pa.int32(), pa.string())),
+    ]
+)
+
+_BUF = []
+_LAST_FLUSH = time.time()
+_NEXT_COMPACTION = 0.0
+
+
+def append_transfer(metrics: dict) -> None:
+    """
+    Buffer a single transfer record and flush the buffer to Parquet
+    once it is full or old enough.
+    """
+    duration = metrics["duration"]
+    bytes_ = metrics["bytes"]
+    throughput = bytes_ / duration if duration > 0 else 0.0
+
+    _BUF.append(
+        {
+            "timestamp_unix": int(metrics["timestamp"]),
+            "bytes": bytes_,
+            "duration": duration,
+            "throughput_bytes_per_sec": throughput,
+            "status": metrics["status"],
+        }
+    )
+
+    if len(_BUF) >= FLUSH_ROWS or time.time() - _LAST_FLUSH >= FLUSH_SECONDS:
+        flush_transfers()
+
+
+def flush_transfers() -> None:
+    """
+    Write all buffered records as a single row group to a new Parquet file.
+    The file is written under a hidden temp name and renamed into place,
+    so readers never pick up a partially written file.
+    """
+    global _LAST_FLUSH
+    _LAST_FLUSH = time.time()
+    if not _BUF:
+        return
+
+    SITE_DIR.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pylist(_BUF, schema=SCHEMA)
+
+    path = SITE_DIR / f"part-{_BUF[0]['timestamp_unix']}-{WRITER_ID}.parquet"
+    tmp_path = SITE_DIR / f".{path.name}.tmp"
+    with pq.ParquetWriter(tmp_path, SCHEMA, compression="snappy") as writer:
+        writer.write_table(table)
+    tmp_path.replace(path)
+
+    _BUF.clear()
+
+
+def hour_of(path: Path) -> int:
+    """Start of the hour a part-<ts>-* or hour-<hour>-* file belongs to."""
+    ts = int(path.stem.split("-", 2)[1])
+    return ts - ts % 3600
+
+
+def compact_closed_hours() -> None:
+    """Compact every closed hour of this site that still has part files."""
+    cutoff = time.time() - COMPACT_GRACE_SECONDS
+    hours = {
+        hour_of(p)
+        for p in SITE_DIR.glob("part-*.parquet")
+        if hour_of(p) + 3600 <= cutoff
+    }
+    for hour in sorted(hours):
+        compact_hour(hour)
 
 
-def append_transfer_to_csv(metrics: dict) -> None:
+def compact_hour(hour: int) -> None:
     """
-    Append a single transfer record to a CSV file.
-    Creates the file with header if it does not exist yet.
+    Merge the part files (and any earlier hour file) of one hour into a new
+    hour-<hour>-<ns>.parquet, written under a hidden temp name and renamed
+    into place before its sources are deleted. The file's metadata maps each
+    source name to its [start, stop) row range, so incremental readers can
+    skip the rows they already ingested. An earlier hour file's own entries
+    are carried over, shifted to its range, so the ranges name both that
+    file and the original parts it was built from.
     """
-    file_exists = TRANSFERS_CSV.exists()
-
-    with open(TRANSFERS_CSV, "a", newline="") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                "timestamp_iso",
-                "timestamp_unix",
-                "bytes",
-                "duration",
-                "throughput_bytes_per_sec",
-                "status",
-                "site",  # NEW column
-            ],
+    lock = SITE_DIR / f".compact-{hour}.lock"
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        # Held by another writer, or left behind by one that died mid-way
+        if time.time() - lock.stat().st_mtime > COMPACT_LOCK_STALE_SECONDS:
+            lock.unlink(missing_ok=True)
+        return
+
+    try:
+        sources = sorted(
+            p
+            for p in list(SITE_DIR.glob("part-*.parquet")) + list(SITE_DIR.glob("hour-*.parquet"))
+            if hour_of(p) == hour
+        )
+        if not any(p.name.startswith("part-") for p in sources):
+            return
+
+        tables = []
+        ranges = {}
+        start = 0
+        for p in sources:
+            table = pq.read_table(p)
+            meta = table.schema.metadata or {}
+            nested = json.loads(meta.get(b"dtms_sources", b"{}"))
+            for name, (a, b) in nested.items():
+                ranges[name] = [start + a, start + b]
+            ranges[p.name] = [start, start + table.num_rows]
+            start += table.num_rows
+            tables.append(table.replace_schema_metadata(None))
+
+        table = pa.concat_tables(tables).replace_schema_metadata(
+            {"dtms_sources": json.dumps(ranges)}
         )
-        if not file_exists:
-            writer.writeheader()
-
-        duration = metrics["duration"]
-        bytes_ = metrics["bytes"]
-        throughput = bytes_ / duration if duration > 0 else 0.0
-
-        writer.writerow(
-            {
-                "timestamp_iso": datetime.fromtimestamp(
-                    metrics["timestamp"], tz=timezone.utc
-                ).isoformat().replace("+00:00", "Z"),
-                "timestamp_unix": metrics["timestamp"],
-                "bytes": bytes_,
-                "duration": duration,
-                "throughput_bytes_per_sec": throughput,
-                "status": metrics["status"],
-                "site": SITE_NAME,  # NEW column value
-            }
+        path = SITE_DIR / f"hour-{hour}-{time.time_ns()}.parquet"
+        tmp_path = SITE_DIR / f".{path.name}.tmp"
+        pq.write_table(
+            table, tmp_path, compression="snappy", row_group_size=COMPACT_ROW_GROUP_ROWS
         )
+        tmp_path.replace(path)
+
+        for p in sources:
+            p.unlink(missing_ok=True)
+        print(f"[EXPORTER][{SITE_NAME}] Compacted {len(sources)} files into {path.name}")
+    finally:
+        lock.unlink(missing_ok=True)
+
+
+def maybe_compact() -> None:
+    """Run compact_closed_hours() at most every COMPACT_CHECK_SECONDS."""
+    global _NEXT_COMPACTION
+    if time.time() < _NEXT_COMPACTION:
+        return
+    _NEXT_COMPACTION = time.time() + COMPACT_CHECK_SECONDS
+    try:
+        compact_closed_hours()
+    except Exception as e:
+        print(f"[ERROR][{SITE_NAME}] Compaction failed: {e}")
 
 
 def run_exporter() -> None:
@@ -112,7 +249,7 @@ def run_exporter() -> None:
             TRANSFER_BYTES.labels(site=SITE_NAME).inc(metrics["bytes"])
             TRANSFER_DURATION.labels(site=SITE_NAME).observe(duration)
 
-            append_transfer_to_csv(metrics)
+            append_transfer(metrics)
 
             print(
                 f"[TRANSFER][{SITE_NAME}] bytes={metrics['bytes']} duration={duration:.4f}s"
@@ -121,6 +258,7 @@ def run_exporter() -> None:
             print(f"[ERROR][{SITE_NAME}] Transfer failed: {e}")
             TRANSFER_FAILURES.labels(site=SITE_NAME).inc()
 
+        maybe_compact()
         time.sleep(2)
 
 
@@ -130,6 +268,11 @@ def main() -> None:
     # Default binds to 0.0.0.0, so Codespaces can port-forward it
     start_http_server(port)
 
+    # Don't lose buffered records on shutdown: turn SIGTERM into a normal
+    # exit so the atexit flush runs
+    atexit.register(flush_transfers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     run_exporter()
 
 
@@ -3,8 +3,12 @@
 Cron job: compute correlation between anomaly counts and throughput
 and push a single metric to Pushgateway.
 
-- Reads from /app/data/parquet/site_aggregates/ if exists (Parquet), else uses transfers.csv
-- Reads anomalies.csv (from anomaly/isolation runner) if exists
+- Reads from /app/data/parquet/site_aggregates/ if exists (Parquet), else the per-site
+  transfers dataset (/app/data/transfers/site=*/), else the legacy transfers.csv
+- Reads the per-site anomalies dataset (/app/data/anomalies/site=*/, from the anomaly
+  exporter / isolation runner) if exists, else the legacy anomalies.csv
+- Parquet inputs are read with a timestamp filter, so row groups older than the
+  lookback window are skipped using their min/max statistics
 - Computes Pearson correlation between per-minute anomaly_count and mean_throughput across sites
 - Pushes metric dtms_corr_anomaly_throughput (float) to Pushgateway job=correlation
 """
@@ -12,38 +16,89 @@ import os
 import time
 import math
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 from pathlib import Path
-from scipy.stats import pearsonr
+
+from anomaly._csv import TRANSFERS_CSV_DTYPES, csv_columns
+from anomaly._fastmath import centered_sums
 
 DATA_DIR = Path("/app/data")
 PARQUET_DIR = DATA_DIR / "parquet" / "site_aggregates"
+TRANSFERS_DIR = DATA_DIR / "transfers"
 TRANSFERS_CSV = DATA_DIR / "transfers.csv"
-ANOMALIES_CSV = DATA_DIR / "anomalies.csv"
+ANOMALIES_DIR = DATA_DIR / "anomalies"
+ANOMALIES_CSV = DATA_DIR / "anomalies.csv"  # legacy, pre-Parquet layout
 
 PUSHGATEWAY = os.environ.get("PUSHGATEWAY_URL", "http://pushgateway:9091")
 JOB_NAME = os.environ.get("PUSHGATEWAY_JOB", "dtms_correlation")
 BUCKET = os.environ.get("PUSHGATEWAY_INSTANCE", "default")
 
+# Above this many points the correlation runs in the (Numba-compiled, if
+# available) parallel kernel; below it the JIT dispatch is not worth it
+FASTMATH_MIN_ROWS = 10_000
+
+# Keep-alive session for Pushgateway calls; retries ride out a Pushgateway restart
+_SESSION = requests.Session()
+_SESSION.mount(
+    "http://",
+    HTTPAdapter(pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.1)),
+)
+
+# Columns (and dtypes) used from the legacy anomalies.csv; transfers.csv uses
+# TRANSFERS_CSV_DTYPES. Only the columns in the header are read, see csv_columns().
+ANOMALIES_CSV_DTYPES = {
+    "timestamp_unix": "float64",
+    "timestamp": "float64",
+    "site": "category",
+}
+
+# Columns used from the Parquet time-series inputs
+TIMESERIES_COLUMNS = ["timestamp_unix", "timestamp", "site", "bytes", "duration", "throughput_bytes_per_sec"]
+
 def load_site_timeseries(minutes=30):
     """Return DataFrame with columns ['minute','site','avg_throughput','anomaly_count'] aggregated per-minute."""
     now = time.time()
     since = now - (minutes * 60)
     dfs = []
     if PARQUET_DIR.exists():
-        # read parquet files (assume they have columns: timestamp_unix, site, throughput)
+        # parquet files (assume they have columns: timestamp_unix, site, throughput);
+        # scan only the used columns present, with the lookback filter pushed down
         try:
-            df = pd.read_parquet(str(PARQUET_DIR))
-        except Exception:
-            # try reading multiple parquet files
-            files = list(PARQUET_DIR.glob("**/*.parquet"))
-            if not files:
-                df = pd.DataFrame()
-            else:
-                df = pd.concat([pd.read_parquet(str(f)) for f in files], ignore_index=True)
+            dataset = ds.dataset(PARQUET_DIR, format="parquet", partitioning="hive")
+            names = dataset.schema.names
+            ts_col = "timestamp_unix" if "timestamp_unix" in names else "timestamp"
+            df = dataset.to_table(
+                columns=[c for c in TIMESERIES_COLUMNS if c in names],
+                filter=(pc.field(ts_col) >= since) if ts_col in names else None,
+            ).to_pandas()
+        except Exception as e:
+            print(f"[CORRELATION] Error reading Parquet aggregates: {e}")
+            df = pd.DataFrame()
+    elif TRANSFERS_DIR.exists():
+        # hive layout: the site column comes from the site=<SITE> directories
+        try:
+            df = ds.dataset(TRANSFERS_DIR, format="parquet", partitioning="hive").to_table(
+                columns=[c for c in TIMESERIES_COLUMNS if c != "timestamp"],
+                filter=pc.field("timestamp_unix") >= since,
+            ).to_pandas()
+        except Exception as e:
+            print(f"[CORRELATION] Error reading transfers dataset: {e}")
+            df = pd.DataFrame()
     elif TRANSFERS_CSV.exists():
         try:
-            df = pd.read_csv(TRANSFERS_CSV, on_bad_lines='skip')
+            dtypes = csv_columns(TRANSFERS_CSV, TRANSFERS_CSV_DTYPES)
+            df = pd.read_csv(
+                TRANSFERS_CSV,
+                engine="pyarrow",
+                usecols=list(dtypes),
+                dtype=dtypes,
+                on_bad_lines='skip',
+            )
             if df.empty:
                 print("[CORRELATION] CSV is empty after skipping bad lines")
                 df = pd.DataFrame()
@@ -71,11 +126,13 @@ def load_site_timeseries(minutes=30):
 
     # throughput: prefer throughput_bytes_per_sec, else compute bytes/duration
     if "throughput_bytes_per_sec" not in df.columns:
-        df["throughput_bytes_per_sec"] = df.apply(lambda r: r["bytes"]/r["duration"] if r.get("duration",0)>0 else 0, axis=1)
+        dur = df["duration"].to_numpy(dtype="float64")
+        byt = df["bytes"].to_numpy(dtype="float64")
+        df["throughput_bytes_per_sec"] = np.where(dur > 0, byt / np.maximum(dur, 1e-12), 0.0)
 
     # round down to minute
-    df["minute"] = (df["timestamp_unix"] // 60).astype(int)
-    agg = df.groupby(["minute","site"]).agg(
+    df["minute"] = df["timestamp_unix"].to_numpy().astype("int64") // 60
+    agg = df.groupby(["minute","site"], observed=True).agg(
         avg_throughput=("throughput_bytes_per_sec","mean"),
         transfers_count=("bytes","count")
     ).reset_index()
@@ -84,15 +141,33 @@ def load_site_timeseries(minutes=30):
 def load_anomalies(minutes=30):
     now = time.time()
     since = now - (minutes * 60)
-    if not ANOMALIES_CSV.exists():
-        return pd.DataFrame()
-    try:
-        df = pd.read_csv(ANOMALIES_CSV, on_bad_lines='skip')
-        if df.empty:
-            print("[CORRELATION] Anomalies CSV is empty after skipping bad lines")
+    if ANOMALIES_DIR.exists():
+        # hive layout: the site column comes from the site=<SITE> directories
+        try:
+            df = ds.dataset(ANOMALIES_DIR, format="parquet", partitioning="hive").to_table(
+                columns=["timestamp_unix", "site"],
+                filter=pc.field("timestamp_unix") >= since,
+            ).to_pandas()
+        except Exception as e:
+            print(f"[CORRELATION] Error reading anomalies Parquet: {e}")
             return pd.DataFrame()
-    except Exception as e:
-        print(f"[CORRELATION] Error reading anomalies CSV: {e}")
+    elif ANOMALIES_CSV.exists():
+        try:
+            dtypes = csv_columns(ANOMALIES_CSV, ANOMALIES_CSV_DTYPES)
+            df = pd.read_csv(
+                ANOMALIES_CSV,
+                engine="pyarrow",
+                usecols=list(dtypes),
+                dtype=dtypes,
+                on_bad_lines='skip',
+            )
+            if df.empty:
+                print("[CORRELATION] Anomalies CSV is empty after skipping bad lines")
+                return pd.DataFrame()
+        except Exception as e:
+            print(f"[CORRELATION] Error reading anomalies CSV: {e}")
+            return pd.DataFrame()
+    else:
         return pd.DataFrame()
     if "timestamp_unix" not in df.columns and "timestamp" in df.columns:
         df["timestamp_unix"] = df["timestamp"]
@@ -100,7 +175,7 @@ def load_anomalies(minutes=30):
     if "site" not in df.columns:
         df["site"] = "UNKNOWN"
     df["minute"] = (df["timestamp_unix"] // 60).astype(int)
-    agg = df.groupby(["minute","site"]).size().reset_index(name="anomaly_count")
+    agg = df.groupby(["minute","site"], observed=True).size().reset_index(name="anomaly_count")
     return agg
 
 def compute_global_correlation(minutes=180):
@@ -110,11 +185,24 @@ def compute_global_correlation(minutes=180):
         return None
     merged = thr.merge(ann, on=["minute","site"], how="outer").fillna(0)
     # for global correlation across all minutes+sites:
-    try:
-        corr, pval = pearsonr(merged["anomaly_count"], merged["avg_throughput"])
-    except Exception:
+    x = merged["anomaly_count"].to_numpy(np.float64)
+    y = merged["avg_throughput"].to_numpy(np.float64)
+    return pearson(x, y)
+
+def pearson(x, y):
+    """Pearson correlation of two float64 arrays: two means and three dot products, no p-value."""
+    if x.size < 2:
+        return None
+    if x.size > FASTMATH_MIN_ROWS:
+        sxy, sxx, syy = centered_sums(x, y)
+    else:
+        dx = x - x.mean()
+        dy = y - y.mean()
+        sxy, sxx, syy = dx @ dy, dx @ dx, dy @ dy
+    denom = math.sqrt(sxx * syy)
+    if denom == 0:
         return None
-    return float(corr)
+    return float(sxy / denom)
 
 def push_to_pushgateway(value):
     # metric name dtms_corr_anomaly_throughput
@@ -122,7 +210,7 @@ def push_to_pushgateway(value):
     payload = f"# TYPE {metric_name} gauge\n{metric_name} {value}\n"
     url = f"{PUSHGATEWAY}/metrics/job/{JOB_NAME}/instance/{BUCKET}"
     try:
-        resp = requests.put(url, data=payload, timeout=10)
+        resp = _SESSION.put(url, data=payload, timeout=10)
         resp.raise_for_status()
         print(f"Pushed {value} to {url} (status {resp.status_code})")
     except Exception as e: